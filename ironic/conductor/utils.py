@@ -13,14 +13,16 @@
 #    under the License.
 
 import collections
+import itertools
+import operator
 import time
 
-from openstack.baremetal import configdrive as os_configdrive
 from oslo_config import cfg
 from oslo_log import log
 from oslo_serialization import jsonutils
 from oslo_service import loopingcall
 from oslo_utils import excutils
+from oslo_utils import timeutils
 import six
 
 from ironic.common import boot_devices
@@ -63,6 +65,29 @@ DEPLOYING_INTERFACE_PRIORITY = {
     'raid': 1,
 }
 
+# Power state of a node after a power action, for each power action
+_TARGET_POWER_STATES = {
+    states.POWER_ON: states.POWER_ON,
+    states.REBOOT: states.POWER_ON,
+    states.SOFT_REBOOT: states.POWER_ON,
+    states.POWER_OFF: states.POWER_OFF,
+    states.SOFT_POWER_OFF: states.POWER_OFF,
+}
+
+# Cache of the power states recently read from the hardware, oldest entry
+# first, in format:
+# {
+#     <node_uuid>: (<power_state>, <time_of_reading>)
+# }
+_POWER_STATE_CACHE = collections.OrderedDict()
+# Maximum number of entries of the power state cache.
+_POWER_STATE_CACHE_SIZE = 1024
+
+# Fields of a deploy template step which are copied into the node's deploy
+# steps, and a getter returning their values.
+_STEP_FIELDS = ('interface', 'step', 'args', 'priority')
+_get_step_field_values = operator.itemgetter(*_STEP_FIELDS)
+
 
 @task_manager.require_exclusive_lock
 def node_set_boot_device(task, device, persistent=False):
@@ -171,7 +196,13 @@ def node_wait_for_power_state(task, new_state, timeout=None):
 
     try:
         timer = loopingcall.BackOffLoopingCall(_wait)
-        return timer.start(initial_delay=1, timeout=retry_timeout).wait()
+        # Check the power state right away, so that fast BMCs do not pay
+        # for any wait, then back off starting with a short interval. A
+        # jitter of 0.75 grows the interval by roughly 1.5 on every poll;
+        # max_interval caps it for slow hardware.
+        return timer.start(initial_delay=0, starting_interval=0.05,
+                           max_interval=2, jitter=0.75,
+                           timeout=retry_timeout).wait()
     except loopingcall.LoopingCallTimeOut:
         LOG.error('Timed out after %(retry_timeout)s secs waiting for '
                   '%(state)s on node %(node_id)s.',
@@ -181,13 +212,46 @@ def node_wait_for_power_state(task, new_state, timeout=None):
 
 
 def _calculate_target_state(new_state):
-    if new_state in (states.POWER_ON, states.REBOOT, states.SOFT_REBOOT):
-        target_state = states.POWER_ON
-    elif new_state in (states.POWER_OFF, states.SOFT_POWER_OFF):
-        target_state = states.POWER_OFF
-    else:
-        target_state = None
-    return target_state
+    return _TARGET_POWER_STATES.get(new_state)
+
+
+def _cache_power_state(node, power_state):
+    """Remember the power state of a node read from the hardware.
+
+    :param node: an Ironic node object.
+    :param power_state: the power state of the node, or None to forget it.
+    """
+    _POWER_STATE_CACHE.pop(node.uuid, None)
+    if power_state is None or not CONF.conductor.cached_power_state_ttl:
+        return
+
+    # Entries are kept in the order they were added, drop the oldest ones
+    # when the cache is full.
+    while len(_POWER_STATE_CACHE) >= _POWER_STATE_CACHE_SIZE:
+        _POWER_STATE_CACHE.popitem(last=False)
+    _POWER_STATE_CACHE[node.uuid] = (power_state, timeutils.now())
+
+
+def _get_cached_power_state(node):
+    """Get the power state of a node if it was recently read.
+
+    :param node: an Ironic node object.
+    :returns: the power state of the node if it was read from the hardware
+        less than ``[conductor]cached_power_state_ttl`` seconds ago and it
+        still matches the power state of the node, None otherwise.
+    """
+    cached = _POWER_STATE_CACHE.get(node.uuid)
+    if cached is None:
+        return
+
+    power_state, read_at = cached
+    # Never trust an entry with a negative age, should the clock go back.
+    age = timeutils.now() - read_at
+    if not 0 <= age < CONF.conductor.cached_power_state_ttl:
+        del _POWER_STATE_CACHE[node.uuid]
+        return
+    if power_state == node.power_state:
+        return power_state
 
 
 def _can_skip_state_change(task, new_state):
@@ -231,22 +295,28 @@ def _can_skip_state_change(task, new_state):
         notify_utils.emit_power_set_notification(
             task, fields.NotificationLevel.INFO,
             fields.NotificationStatus.END, new_state)
-        LOG.warning("Not going to change node %(node)s power state because "
-                    "current state = requested state = '%(state)s'.",
-                    {'node': node.uuid, 'state': curr_state})
-
-    try:
-        curr_state = task.driver.power.get_power_state(task)
-    except Exception as e:
-        with excutils.save_and_reraise_exception():
-            node['last_error'] = _(
-                "Failed to change power state to '%(target)s'. "
-                "Error: %(error)s") % {'target': new_state, 'error': e}
-            node['target_power_state'] = states.NOSTATE
-            node.save()
-            notify_utils.emit_power_set_notification(
-                task, fields.NotificationLevel.ERROR,
-                fields.NotificationStatus.ERROR, new_state)
+        if LOG.isEnabledFor(log.WARNING):
+            LOG.warning("Not going to change node %(node)s power state "
+                        "because current state = requested state = "
+                        "'%(state)s'.",
+                        {'node': node.uuid, 'state': curr_state})
+
+    # Avoid querying the hardware if its power state was read very recently
+    curr_state = _get_cached_power_state(node)
+    if curr_state is None:
+        try:
+            curr_state = task.driver.power.get_power_state(task)
+        except Exception as e:
+            with excutils.save_and_reraise_exception():
+                node['last_error'] = _(
+                    "Failed to change power state to '%(target)s'. "
+                    "Error: %(error)s") % {'target': new_state, 'error': e}
+                node['target_power_state'] = states.NOSTATE
+                node.save()
+                notify_utils.emit_power_set_notification(
+                    task, fields.NotificationLevel.ERROR,
+                    fields.NotificationStatus.ERROR, new_state)
+        _cache_power_state(node, curr_state)
 
     if curr_state == states.POWER_ON:
         if new_state == states.POWER_ON:
@@ -282,23 +352,32 @@ def node_power_action(task, new_state, timeout=None):
              wrong occurred during the power action.
 
     """
-    notify_utils.emit_power_set_notification(
-        task, fields.NotificationLevel.INFO, fields.NotificationStatus.START,
-        new_state)
     node = task.node
 
+    # Check this before emitting the start notification: if the node is
+    # already in the requested state, only the end notification is sent.
     if _can_skip_state_change(task, new_state):
         return
+
+    notify_utils.emit_power_set_notification(
+        task, fields.NotificationLevel.INFO, fields.NotificationStatus.START,
+        new_state)
     target_state = _calculate_target_state(new_state)
 
     # Set the target_power_state and clear any last_error, if we're
     # starting a new operation. This will expose to other processes
-    # and clients that work is in progress.
+    # and clients that work is in progress. Callers going through the
+    # conductor manager have already saved the target_power_state, so
+    # for them the only node.save() is the one with the outcome below.
     if node['target_power_state'] != target_state:
         node['target_power_state'] = target_state
         node['last_error'] = None
         node.save()
 
+    # A power state read from the hardware is no longer valid once a power
+    # action is taken. Only states read from the hardware are cached.
+    _cache_power_state(node, None)
+
     # take power action
     try:
         if (target_state == states.POWER_ON
@@ -333,11 +412,12 @@ def node_power_action(task, new_state, timeout=None):
         notify_utils.emit_power_set_notification(
             task, fields.NotificationLevel.INFO, fields.NotificationStatus.END,
             new_state)
-        LOG.info('Successfully set node %(node)s power state to '
-                 '%(target_state)s by %(new_state)s.',
-                 {'node': node.uuid,
-                  'target_state': target_state,
-                  'new_state': new_state})
+        if LOG.isEnabledFor(log.INFO):
+            LOG.info('Successfully set node %(node)s power state to '
+                     '%(target_state)s by %(new_state)s.',
+                     {'node': node.uuid,
+                      'target_state': target_state,
+                      'new_state': new_state})
         # NOTE(TheJulia): Similarly to power-on, when we power-off
         # a node, we should detach any volume attachments.
         if (target_state == states.POWER_OFF
@@ -392,6 +472,26 @@ def provisioning_error_handler(e, node, provision_state,
                      'tgt_prov_state': target_provision_state})
 
 
+def _process_event_and_save(task, event, **kwargs):
+    """Process an event for the task, saving the node in any case.
+
+    process_event() saves the node along with any changes made to it before
+    the event was processed. This helper makes sure that these changes are
+    saved even if the event cannot be processed.
+
+    :param task: a TaskManager instance.
+    :param event: the name of the event to process.
+    :param kwargs: additional keyword arguments for process_event().
+    :raises: InvalidState if the event is not allowed by the associated
+             state machine.
+    """
+    try:
+        task.process_event(event, **kwargs)
+    except exception.InvalidState:
+        with excutils.save_and_reraise_exception():
+            task.node.save()
+
+
 def cleanup_cleanwait_timeout(task):
     """Cleanup a cleaning task after timeout.
 
@@ -439,11 +539,13 @@ def cleaning_error_handler(task, msg, tear_down_cleaning=True,
     node.maintenance = True
     node.maintenance_reason = msg
     node.fault = faults.CLEAN_FAILURE
-    node.save()
 
     if set_fail_state and node.provision_state != states.CLEANFAIL:
         target_state = states.MANAGEABLE if manual_clean else None
-        task.process_event('fail', target_state=target_state)
+        # process_event() saves the node, including the changes above.
+        _process_event_and_save(task, 'fail', target_state=target_state)
+    else:
+        node.save()
 
 
 def deploying_error_handler(task, logmsg, errmsg, traceback=False,
@@ -491,10 +593,10 @@ def deploying_error_handler(task, logmsg, errmsg, traceback=False,
 
     if cleanup_err:
         node.last_error = cleanup_err
-    node.save()
 
     # NOTE(deva): there is no need to clear conductor_affinity
-    task.process_event('fail')
+    # process_event() saves the node, including the changes above.
+    _process_event_and_save(task, 'fail')
 
 
 @task_manager.require_exclusive_lock
@@ -544,12 +646,13 @@ def rescuing_error_handler(task, msg, set_fail_state=True):
                            {'error': e})
         LOG.exception('Rescue failed for node %(node)s, an exception was '
                       'encountered while aborting.', {'node': node.uuid})
-    finally:
-        node.save()
 
-    if set_fail_state:
+    if not set_fail_state:
+        node.save()
+    else:
         try:
-            task.process_event('fail')
+            # process_event() saves the node, including the changes above.
+            _process_event_and_save(task, 'fail')
         except exception.InvalidState:
             node = task.node
             LOG.error('Internal error. Node %(node)s in provision state '
@@ -630,38 +733,36 @@ def power_state_error_handler(e, node, power_state):
                     {'node': node.uuid, 'power_state': power_state})
 
 
-def _clean_step_key(step):
-    """Sort by priority, then interface priority in event of tie.
+def _sort_decorated_steps(decorated_steps):
+    """Sort steps decorated with their sort keys, and strip the keys.
 
-    :param step: cleaning step dict to get priority for.
+    :param decorated_steps: A list of (priority, interface priority, step)
+        tuples; sorted in place.
+    :returns: A list of step dictionaries, sorted from highest priority to
+        lowest priority. For steps having the same priority, they are sorted
+        from highest interface priority to lowest.
     """
-    return (step.get('priority'),
-            CLEANING_INTERFACE_PRIORITY[step.get('interface')])
-
-
-def _deploy_step_key(step):
-    """Sort by priority, then interface priority in event of tie.
-
-    :param step: deploy step dict to get priority for.
-    """
-    return (step.get('priority'),
-            DEPLOYING_INTERFACE_PRIORITY[step.get('interface')])
+    # Sort the steps from higher priority to lower priority
+    decorated_steps.sort(key=operator.itemgetter(0, 1), reverse=True)
+    return [step for _priority, _interface_priority, step in decorated_steps]
 
 
-def _sorted_steps(steps, sort_step_key):
+def _sorted_steps(steps, interface_priorities):
     """Return a sorted list of steps.
 
-    :param sort_step_key: If set, this is a method (key) used to sort the steps
-        from highest priority to lowest priority. For steps having the same
-        priority, they are sorted from highest interface priority to lowest.
-    :returns: A list of sorted step dictionaries.
+    :param steps: A list of step dictionaries.
+    :param interface_priorities: A dictionary of (key) interfaces and their
+        (value) priorities, used for sorting steps having the same priority.
+    :returns: A list of step dictionaries, sorted from highest priority to
+        lowest priority. For steps having the same priority, they are sorted
+        from highest interface priority to lowest.
     """
-    # Sort the steps from higher priority to lower priority
-    return sorted(steps, key=sort_step_key, reverse=True)
+    return _sort_decorated_steps(
+        [(step.get('priority'), interface_priorities[step.get('interface')],
+          step) for step in steps])
 
 
-def _get_steps(task, interfaces, get_method, enabled=False,
-               sort_step_key=None):
+def _get_steps(task, interfaces, get_method, enabled=False, sort=False):
     """Get steps for task.node.
 
     :param task: A TaskManager object
@@ -673,24 +774,26 @@ def _get_steps(task, interfaces, get_method, enabled=False,
         interface; a string.
     :param enabled: If True, returns only enabled (priority > 0) steps. If
         False, returns all steps.
-    :param sort_step_key: If set, this is a method (key) used to sort the steps
-        from highest priority to lowest priority. For steps having the same
-        priority, they are sorted from highest interface priority to lowest.
+    :param sort: If True, the steps are sorted from highest priority to lowest
+        priority. For steps having the same priority, they are sorted from
+        highest interface priority to lowest.
     :raises: NodeCleaningFailure or InstanceDeployFailure if there was a
         problem getting the steps.
     :returns: A list of step dictionaries
     """
-    # Get steps from each interface
+    # Get steps from each interface, along with their sort keys
     steps = list()
-    for interface in interfaces:
-        interface = getattr(task.driver, interface)
-        if interface:
-            interface_steps = [x for x in getattr(interface, get_method)(task)
-                               if not enabled or x['priority'] > 0]
-            steps.extend(interface_steps)
-    if sort_step_key:
-        steps = _sorted_steps(steps, sort_step_key)
-    return steps
+    for interface_name, interface_priority in interfaces.items():
+        interface = getattr(task.driver, interface_name)
+        if not interface:
+            continue
+        get_interface_steps = getattr(interface, get_method)
+        steps.extend((x.get('priority'), interface_priority, x)
+                     for x in get_interface_steps(task)
+                     if not enabled or x['priority'] > 0)
+    if sort:
+        return _sort_decorated_steps(steps)
+    return [step for _priority, _interface_priority, step in steps]
 
 
 def _get_cleaning_steps(task, enabled=False, sort=True):
@@ -706,9 +809,8 @@ def _get_cleaning_steps(task, enabled=False, sort=True):
         clean steps.
     :returns: A list of clean step dictionaries
     """
-    sort_key = _clean_step_key if sort else None
     return _get_steps(task, CLEANING_INTERFACE_PRIORITY, 'get_clean_steps',
-                      enabled=enabled, sort_step_key=sort_key)
+                      enabled=enabled, sort=sort)
 
 
 def _get_deployment_steps(task, enabled=False, sort=True):
@@ -724,9 +826,8 @@ def _get_deployment_steps(task, enabled=False, sort=True):
         deploy steps.
     :returns: A list of deploy step dictionaries
     """
-    sort_key = _deploy_step_key if sort else None
     return _get_steps(task, DEPLOYING_INTERFACE_PRIORITY, 'get_deploy_steps',
-                      enabled=enabled, sort_step_key=sort_key)
+                      enabled=enabled, sort=sort)
 
 
 def set_node_cleaning_steps(task):
@@ -757,12 +858,12 @@ def set_node_cleaning_steps(task):
         # user and already saved in node.driver_internal_info['clean_steps'].
         # Now that we know what the driver's available clean steps are, we can
         # do further checks to validate the user's clean steps.
-        steps = node.driver_internal_info['clean_steps']
+        steps = driver_internal_info['clean_steps']
         driver_internal_info['clean_steps'] = (
             _validate_user_clean_steps(task, steps))
 
-    node.clean_step = {}
     driver_internal_info['clean_step_index'] = None
+    node.clean_step = {}
     node.driver_internal_info = driver_internal_info
     node.save()
 
@@ -777,10 +878,9 @@ def _get_deployment_templates(task):
     :param task: A TaskManager object
     :returns: a list of DeployTemplate objects.
     """
-    node = task.node
-    if not node.instance_info.get('traits'):
+    instance_traits = task.node.instance_info.get('traits')
+    if not instance_traits:
         return []
-    instance_traits = node.instance_info['traits']
     return deploy_template.DeployTemplate.list_by_names(task.context,
                                                         instance_traits)
 
@@ -798,12 +898,9 @@ def _get_steps_from_deployment_templates(task):
     :returns: A list of deploy step dictionaries
     """
     templates = _get_deployment_templates(task)
-    steps = []
-    step_fields = ('interface', 'step', 'args', 'priority')
-    for template in templates:
-        steps.extend([{key: step[key] for key in step_fields}
-                      for step in template.steps])
-    return steps
+    return [dict(zip(_STEP_FIELDS, _get_step_field_values(step)))
+            for step in itertools.chain.from_iterable(
+                template.steps for template in templates)]
 
 
 def _get_all_deployment_steps(task):
@@ -824,15 +921,14 @@ def _get_all_deployment_steps(task):
     driver_steps = _get_deployment_steps(task, enabled=True, sort=False)
 
     # Remove driver steps that have been disabled or overridden by user steps.
-    user_step_keys = {(s['interface'], s['step']) for s in user_steps}
+    user_step_keys = frozenset((s['interface'], s['step']) for s in user_steps)
     steps = [s for s in driver_steps
              if (s['interface'], s['step']) not in user_step_keys]
 
     # Add enabled user steps.
-    enabled_user_steps = [s for s in user_steps if s['priority'] > 0]
-    steps.extend(enabled_user_steps)
+    steps.extend(s for s in user_steps if s['priority'] > 0)
 
-    return _sorted_steps(steps, _deploy_step_key)
+    return _sorted_steps(steps, DEPLOYING_INTERFACE_PRIORITY)
 
 
 def set_node_deployment_steps(task):
@@ -846,8 +942,8 @@ def set_node_deployment_steps(task):
     node = task.node
     driver_internal_info = node.driver_internal_info
     driver_internal_info['deploy_steps'] = _get_all_deployment_steps(task)
-    node.deploy_step = {}
     driver_internal_info['deploy_step_index'] = None
+    node.deploy_step = {}
     node.driver_internal_info = driver_internal_info
     node.save()
 
@@ -872,15 +968,19 @@ def _validate_deploy_steps_unique(user_steps):
     # Check for duplicate steps. Each interface/step combination can be
     # specified at most once.
     errors = []
-    counter = collections.Counter((step['interface'], step['step'])
-                                  for step in user_steps)
-    for (interface, step), count in counter.items():
-        if count > 1:
+    seen = set()
+    duplicates = set()
+    for user_step in user_steps:
+        key = (user_step['interface'], user_step['step'])
+        if key not in seen:
+            seen.add(key)
+        elif key not in duplicates:
+            duplicates.add(key)
             err = (_('duplicate deploy steps for %(interface)s.%(step)s. '
                      'Deploy steps from all deploy templates matching a '
                      'node\'s instance traits cannot have the same interface '
                      'and step') %
-                   {'interface': interface, 'step': step})
+                   {'interface': key[0], 'step': key[1]})
             errors.append(err)
     return errors
 
@@ -930,7 +1030,7 @@ def _validate_user_step(task, user_step, driver_step, step_type):
     # Check that the user-specified arguments are valid
     argsinfo = driver_step.get('argsinfo') or {}
     user_args = user_step.get('args') or {}
-    invalid = set(user_args) - set(argsinfo)
+    invalid = [arg for arg in user_args if arg not in argsinfo]
     if invalid:
         error = (_('%(type)s step %(step)s has these invalid arguments: '
                    '%(invalid)s') %
@@ -1017,20 +1117,30 @@ def _validate_user_steps(task, user_steps, driver_steps, step_type):
         there was a problem getting the steps from the driver.
     :return: validated steps updated with information from the driver
     """
-
-    def step_id(step):
-        return '.'.join([step['step'], step['interface']])
-
     errors = []
 
-    # Convert driver steps to a dict.
-    driver_steps = {step_id(s): s for s in driver_steps}
+    # Convert driver steps to a dict, keyed by (step, interface).
+    driver_steps = {(s['step'], s['interface']): s for s in driver_steps}
+
+    unique = step_type == 'deploy'
+    if unique:
+        # Deploy steps should be unique across all combined templates.
+        dup_errors = _validate_deploy_steps_unique(user_steps)
+        errors.extend(dup_errors)
+    seen = set()
 
     for user_step in user_steps:
+        key = (user_step['step'], user_step['interface'])
+        if unique:
+            # Repeated deploy steps have already been reported as
+            # duplicates, only validate their first occurrence.
+            if key in seen:
+                continue
+            seen.add(key)
+
         # Check if this user_specified step isn't supported by the driver
-        try:
-            driver_step = driver_steps[step_id(user_step)]
-        except KeyError:
+        driver_step = driver_steps.get(key)
+        if driver_step is None:
             error = (_('node does not support this %(type)s step: %(step)s')
                      % {'type': step_type, 'step': user_step})
             errors.append(error)
@@ -1040,11 +1150,6 @@ def _validate_user_steps(task, user_steps, driver_steps, step_type):
                                           step_type)
         errors.extend(step_errors)
 
-    if step_type == 'deploy':
-        # Deploy steps should be unique across all combined templates.
-        dup_errors = _validate_deploy_steps_unique(user_steps)
-        errors.extend(dup_errors)
-
     if errors:
         raise exception.InvalidParameterValue('; '.join(errors))
 
@@ -1205,11 +1310,18 @@ def validate_instance_info_traits(node):
     instance_traits = node.instance_info['traits']
     if not isinstance(instance_traits, list):
         invalid()
-    if not all(isinstance(t, six.string_types) for t in instance_traits):
-        invalid()
-
-    node_traits = node.traits.get_trait_names()
-    missing = set(instance_traits) - set(node_traits)
+    for trait in instance_traits:
+        if not isinstance(trait, six.string_types):
+            invalid()
+
+    node_traits = frozenset(node.traits.get_trait_names())
+    # Report each missing trait once, in the order it was requested.
+    missing = []
+    seen = set()
+    for trait in instance_traits:
+        if trait not in node_traits and trait not in seen:
+            seen.add(trait)
+            missing.append(trait)
     if missing:
         err = (_("Cannot specify instance traits that are not also set on the "
                  "node. Node %(node)s is missing traits %(traits)s") %
@@ -1331,7 +1443,8 @@ def build_configdrive(node, configdrive):
         ``network_data`` and ``user_data`` (all optional).
     :returns: A gzipped and base64 encoded configdrive as a string.
     """
-    meta_data = configdrive.setdefault('meta_data', {})
+    # Copy the meta_data so that the caller's configdrive is not modified.
+    meta_data = dict(configdrive.get('meta_data') or {})
     meta_data.setdefault('uuid', node.uuid)
     if node.name:
         meta_data.setdefault('name', node.name)
@@ -1339,9 +1452,14 @@ def build_configdrive(node, configdrive):
     user_data = configdrive.get('user_data')
     if isinstance(user_data, (dict, list)):
         user_data = jsonutils.dump_as_bytes(user_data)
-    elif user_data:
+    elif isinstance(user_data, six.text_type):
         user_data = user_data.encode('utf-8')
 
+    # openstacksdk is slow to import and only needed here, so it is
+    # imported lazily to avoid slowing down the start up of the API and
+    # conductor services.
+    from openstack.baremetal import configdrive as os_configdrive
+
     LOG.debug('Building a configdrive for node %s', node.uuid)
     return os_configdrive.build(meta_data, user_data=user_data,
                                 network_data=configdrive.get('network_data'))
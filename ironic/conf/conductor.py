@@ -185,6 +185,14 @@ opts = [
                       'complete, i.e., so that a baremetal node is in the '
                       'desired power state. If timed out, the power operation '
                       'is considered a failure.')),
+    cfg.IntOpt('cached_power_state_ttl',
+               min=0, default=5,
+               help=_('Number of seconds a power state read from the '
+                      'hardware by this conductor is considered fresh. '
+                      'A power on or power off request for a node which '
+                      'was recently seen in the requested power state is '
+                      'ignored without querying the hardware again. Set to '
+                      '0 to always query the hardware.')),
     cfg.IntOpt('power_failure_recovery_interval',
                min=0, default=300,
                help=_('Interval (in seconds) between checking the power '
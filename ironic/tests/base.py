@@ -43,6 +43,7 @@ from ironic.common import context as ironic_context
 from ironic.common import driver_factory
 from ironic.common import hash_ring
 from ironic.common import utils as common_utils
+from ironic.conductor import utils as conductor_utils
 from ironic.conf import CONF
 from ironic.drivers import base as drivers_base
 from ironic.objects import base as objects_base
@@ -94,6 +95,7 @@ class TestCase(oslo_test_base.BaseTestCase):
 
         self.addCleanup(self._clear_attrs)
         self.addCleanup(hash_ring.HashRingManager().reset)
+        self.addCleanup(conductor_utils._POWER_STATE_CACHE.clear)
         self.useFixture(fixtures.EnvironmentVariable('http_proxy'))
         self.policy = self.useFixture(policy_fixture.PolicyFixture())
 
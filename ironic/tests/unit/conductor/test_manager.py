@@ -289,18 +289,12 @@ class ChangeNodePowerStateTestCase(mgr_utils.ServiceSetUpMixin,
 
         get_power_mock.assert_called_once_with(mock.ANY, mock.ANY)
 
-        # 2 notifications should be sent: 1 .start and 1 .error
-        self.assertEqual(2, mock_notif.call_count)
-        self.assertEqual(2, mock_notif.return_value.emit.call_count)
+        # Only the .error notification is sent, no .start
+        self.assertEqual(1, mock_notif.call_count)
+        self.assertEqual(1, mock_notif.return_value.emit.call_count)
 
-        first_notif_args = mock_notif.call_args_list[0][1]
-        second_notif_args = mock_notif.call_args_list[1][1]
-
-        self.assertNotificationEqual(first_notif_args,
-                                     'ironic-conductor', CONF.host,
-                                     'baremetal.node.power_set.start',
-                                     obj_fields.NotificationLevel.INFO)
-        self.assertNotificationEqual(second_notif_args,
+        notif_args = mock_notif.call_args[1]
+        self.assertNotificationEqual(notif_args,
                                      'ironic-conductor', CONF.host,
                                      'baremetal.node.power_set.error',
                                      obj_fields.NotificationLevel.ERROR)
@@ -392,18 +386,12 @@ class ChangeNodePowerStateTestCase(mgr_utils.ServiceSetUpMixin,
         # Give async worker a chance to finish
         self._stop_service()
 
-        # 2 notifications should be sent: 1 .start and 1 .end
-        self.assertEqual(2, mock_notif.call_count)
-        self.assertEqual(2, mock_notif.return_value.emit.call_count)
-
-        first_notif_args = mock_notif.call_args_list[0][1]
-        second_notif_args = mock_notif.call_args_list[1][1]
+        # Only the .end notification is sent, no .start
+        self.assertEqual(1, mock_notif.call_count)
+        self.assertEqual(1, mock_notif.return_value.emit.call_count)
 
-        self.assertNotificationEqual(first_notif_args,
-                                     'ironic-conductor', CONF.host,
-                                     'baremetal.node.power_set.start',
-                                     obj_fields.NotificationLevel.INFO)
-        self.assertNotificationEqual(second_notif_args,
+        notif_args = mock_notif.call_args[1]
+        self.assertNotificationEqual(notif_args,
                                      'ironic-conductor', CONF.host,
                                      'baremetal.node.power_set.end',
                                      obj_fields.NotificationLevel.INFO)
@@ -2110,6 +2098,19 @@ class DoNodeDeployTestCase(mgr_utils.ServiceSetUpMixin, db_base.DbTestCase):
                                         network_data=None,
                                         user_data=b'{"user": "data"}')
 
+    @mock.patch('openstack.baremetal.configdrive.build', autospec=True)
+    def test__do_node_deploy_configdrive_and_user_data_as_bytes(
+            self, mock_cd):
+        mock_cd.return_value = 'foo'
+        configdrive = {'user_data': b'abcd'}
+        self._test__do_node_deploy_ok(configdrive=configdrive,
+                                      expected_configdrive='foo')
+        mock_cd.assert_called_once_with({'uuid': self.node.uuid},
+                                        network_data=None,
+                                        user_data=b'abcd')
+        # The caller's configdrive is not modified
+        self.assertEqual({'user_data': b'abcd'}, configdrive)
+
     @mock.patch.object(swift, 'SwiftAPI')
     @mock.patch('ironic.drivers.modules.fake.FakeDeploy.prepare')
     def test__do_node_deploy_configdrive_swift_error(self, mock_prepare,
@@ -2145,7 +2146,7 @@ class DoNodeDeployTestCase(mgr_utils.ServiceSetUpMixin, db_base.DbTestCase):
         with mock.patch.object(dbapi.IMPL, 'update_node') as mock_db:
             db_node = self.dbapi.get_node_by_uuid(node.uuid)
             mock_db.side_effect = [db_exception.DBDataError('DB error'),
-                                   db_node, db_node, db_node]
+                                   db_node, db_node]
             self.assertRaises(db_exception.DBDataError,
                               manager.do_node_deploy, task,
                               self.service.conductor.id,
@@ -2161,9 +2162,7 @@ class DoNodeDeployTestCase(mgr_utils.ServiceSetUpMixin, db_base.DbTestCase):
                 mock.call(node.uuid,
                           {'version': mock.ANY,
                            'deploy_step': {},
-                           'driver_internal_info': mock.ANY}),
-                mock.call(node.uuid,
-                          {'version': mock.ANY,
+                           'driver_internal_info': mock.ANY,
                            'provision_state': states.DEPLOYFAIL,
                            'target_provision_state': states.ACTIVE}),
             ]
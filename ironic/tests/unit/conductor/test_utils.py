@@ -173,6 +173,60 @@ class NodePowerActionTestCase(db_base.DbTestCase):
         self.assertIsNone(node['target_power_state'])
         self.assertIsNone(node['last_error'])
 
+    @mock.patch.object(objects.Node, 'save', autospec=True)
+    @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
+    def test_node_power_action_power_on_single_save(self, get_power_mock,
+                                                    save_mock):
+        """Test node_power_action saves the node only once.
+
+        This is the case when the caller has already saved the
+        target_power_state, as the conductor manager does.
+        """
+        node = obj_utils.create_test_node(self.context,
+                                          uuid=uuidutils.generate_uuid(),
+                                          driver='fake-hardware',
+                                          power_state=states.POWER_OFF,
+                                          target_power_state=states.POWER_ON)
+        task = task_manager.TaskManager(self.context, node.uuid)
+
+        get_power_mock.return_value = states.POWER_OFF
+
+        conductor_utils.node_power_action(task, states.POWER_ON)
+
+        save_mock.assert_called_once_with(task.node)
+        self.assertEqual(states.POWER_ON, task.node.power_state)
+        self.assertIsNone(task.node.target_power_state)
+        self.assertIsNone(task.node.last_error)
+
+    @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
+    def test_node_power_action_power_on_saves_target(self, get_power_mock):
+        """Test node_power_action saves the target before acting."""
+        node = obj_utils.create_test_node(self.context,
+                                          uuid=uuidutils.generate_uuid(),
+                                          driver='fake-hardware',
+                                          power_state=states.POWER_OFF,
+                                          last_error='failed before')
+        task = task_manager.TaskManager(self.context, node.uuid)
+
+        get_power_mock.return_value = states.POWER_OFF
+
+        def _check_saved_target(driver, task, power_state, timeout=None):
+            node.refresh()
+            self.assertEqual(states.POWER_ON, node.target_power_state)
+            self.assertIsNone(node.last_error)
+
+        with mock.patch.object(fake.FakePower, 'set_power_state',
+                               side_effect=_check_saved_target,
+                               autospec=True) as set_power_mock:
+            conductor_utils.node_power_action(task, states.POWER_ON)
+
+        set_power_mock.assert_called_once_with(mock.ANY, mock.ANY,
+                                               states.POWER_ON, timeout=None)
+        node.refresh()
+        self.assertEqual(states.POWER_ON, node.power_state)
+        self.assertIsNone(node.target_power_state)
+        self.assertIsNone(node.last_error)
+
     @mock.patch('ironic.objects.node.NodeSetPowerStateNotification')
     @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
     def test_node_power_action_power_on_notify(self, get_power_mock,
@@ -463,18 +517,12 @@ class NodePowerActionTestCase(db_base.DbTestCase):
         self.assertIsNone(node.target_power_state)
         self.assertIsNotNone(node.last_error)
 
-        # 2 notifications should be sent: 1 .start and 1 .error
-        self.assertEqual(2, mock_notif.call_count)
-        self.assertEqual(2, mock_notif.return_value.emit.call_count)
-
-        first_notif_args = mock_notif.call_args_list[0][1]
-        second_notif_args = mock_notif.call_args_list[1][1]
+        # Only the .error notification is sent, no .start
+        self.assertEqual(1, mock_notif.call_count)
+        self.assertEqual(1, mock_notif.return_value.emit.call_count)
 
-        self.assertNotificationEqual(first_notif_args,
-                                     'ironic-conductor', CONF.host,
-                                     'baremetal.node.power_set.start',
-                                     obj_fields.NotificationLevel.INFO)
-        self.assertNotificationEqual(second_notif_args,
+        notif_args = mock_notif.call_args[1]
+        self.assertNotificationEqual(notif_args,
                                      'ironic-conductor', CONF.host,
                                      'baremetal.node.power_set.error',
                                      obj_fields.NotificationLevel.ERROR)
@@ -678,6 +726,126 @@ class NodePowerActionTestCase(db_base.DbTestCase):
             u"current state = requested state = '%(state)s'.",
             {'state': states.POWER_ON, 'node': node.uuid})
 
+    @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
+    def test__can_skip_state_change_cached_power_state(self, get_power_mock):
+        """Test that a recently read power state is not read again."""
+        node = obj_utils.create_test_node(self.context,
+                                          uuid=uuidutils.generate_uuid(),
+                                          driver='fake-hardware',
+                                          power_state=states.POWER_ON)
+        task = task_manager.TaskManager(self.context, node.uuid)
+
+        get_power_mock.return_value = states.POWER_ON
+
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        get_power_mock.assert_called_once_with(mock.ANY, mock.ANY)
+
+    @mock.patch.object(conductor_utils, 'timeutils', autospec=True)
+    @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
+    def test__can_skip_state_change_cached_power_state_expired(
+            self, get_power_mock, mock_timeutils):
+        """Test that an expired power state is read again."""
+        node = obj_utils.create_test_node(self.context,
+                                          uuid=uuidutils.generate_uuid(),
+                                          driver='fake-hardware',
+                                          power_state=states.POWER_ON)
+        task = task_manager.TaskManager(self.context, node.uuid)
+
+        get_power_mock.return_value = states.POWER_ON
+        mock_timeutils.now.return_value = 1000
+
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        mock_timeutils.now.return_value = 1005
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        self.assertEqual(2, get_power_mock.call_count)
+
+    @mock.patch.object(conductor_utils, 'timeutils', autospec=True)
+    @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
+    def test__can_skip_state_change_cached_power_state_clock_backwards(
+            self, get_power_mock, mock_timeutils):
+        """Test that a power state read in the future is read again."""
+        node = obj_utils.create_test_node(self.context,
+                                          uuid=uuidutils.generate_uuid(),
+                                          driver='fake-hardware',
+                                          power_state=states.POWER_ON)
+        task = task_manager.TaskManager(self.context, node.uuid)
+
+        get_power_mock.return_value = states.POWER_ON
+        mock_timeutils.now.return_value = 1000
+
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        mock_timeutils.now.return_value = 900
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        self.assertEqual(2, get_power_mock.call_count)
+
+    @mock.patch.object(conductor_utils, 'timeutils', autospec=True)
+    def test__get_cached_power_state_expired_evicted(self, mock_timeutils):
+        node = obj_utils.get_test_node(self.context,
+                                       power_state=states.POWER_ON)
+        mock_timeutils.now.return_value = 1000
+        conductor_utils._cache_power_state(node, states.POWER_ON)
+        self.assertEqual(states.POWER_ON,
+                         conductor_utils._get_cached_power_state(node))
+
+        mock_timeutils.now.return_value = 1005
+        self.assertIsNone(conductor_utils._get_cached_power_state(node))
+        self.assertNotIn(node.uuid, conductor_utils._POWER_STATE_CACHE)
+
+    @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
+    def test_node_power_action_power_state_not_cached(self, get_power_mock):
+        """Test that only power states read from the hardware are cached."""
+        node = obj_utils.create_test_node(self.context,
+                                          uuid=uuidutils.generate_uuid(),
+                                          driver='fake-hardware',
+                                          power_state=states.POWER_OFF)
+        task = task_manager.TaskManager(self.context, node.uuid)
+        get_power_mock.return_value = states.POWER_OFF
+
+        conductor_utils.node_power_action(task, states.POWER_ON)
+
+        get_power_mock.assert_called_once_with(mock.ANY, mock.ANY)
+        self.assertEqual(states.POWER_ON, task.node.power_state)
+        self.assertNotIn(node.uuid, conductor_utils._POWER_STATE_CACHE)
+
+    @mock.patch.object(conductor_utils, '_POWER_STATE_CACHE_SIZE', 2)
+    def test__cache_power_state_bounded(self):
+        nodes = [obj_utils.get_test_node(self.context,
+                                         uuid=uuidutils.generate_uuid())
+                 for i in range(3)]
+        for node in nodes:
+            conductor_utils._cache_power_state(node, states.POWER_ON)
+        # Caching a node again makes it the newest entry
+        conductor_utils._cache_power_state(nodes[1], states.POWER_OFF)
+
+        self.assertEqual([nodes[2].uuid, nodes[1].uuid],
+                         list(conductor_utils._POWER_STATE_CACHE))
+
+    @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
+    def test__can_skip_state_change_cached_power_state_disabled(
+            self, get_power_mock):
+        """Test that power states are not cached if disabled."""
+        self.config(cached_power_state_ttl=0, group='conductor')
+        node = obj_utils.create_test_node(self.context,
+                                          uuid=uuidutils.generate_uuid(),
+                                          driver='fake-hardware',
+                                          power_state=states.POWER_ON)
+        task = task_manager.TaskManager(self.context, node.uuid)
+
+        get_power_mock.return_value = states.POWER_ON
+
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        self.assertTrue(conductor_utils._can_skip_state_change(
+            task, states.POWER_ON))
+        self.assertEqual(2, get_power_mock.call_count)
+
     @mock.patch.object(fake.FakePower, 'get_power_state', autospec=True)
     def test__can_skip_state_change_db_not_in_sync(self, get_power_mock):
         """Test setting node state to its present state if DB is out of sync.
@@ -911,7 +1079,7 @@ class DeployingErrorHandlerTestCase(tests_base.TestCase):
         conductor_utils.deploying_error_handler(self.task, self.logmsg,
                                                 self.errmsg)
 
-        self.assertEqual([mock.call()] * 2, self.node.save.call_args_list)
+        self.node.save.assert_called_once_with()
         self.task.driver.deploy.clean_up.assert_called_once_with(self.task)
         self.assertEqual(self.errmsg, self.node.last_error)
         self.assertEqual({}, self.node.deploy_step)
@@ -926,7 +1094,7 @@ class DeployingErrorHandlerTestCase(tests_base.TestCase):
                                                 self.errmsg)
 
         self.task.driver.deploy.clean_up.assert_called_once_with(self.task)
-        self.assertEqual([mock.call()] * 2, self.node.save.call_args_list)
+        self.node.save.assert_called_once_with()
         self.assertIn(expected_str, self.node.last_error)
         self.assertEqual({}, self.node.deploy_step)
         self.assertNotIn('deploy_step_index', self.node.driver_internal_info)
@@ -945,12 +1113,24 @@ class DeployingErrorHandlerTestCase(tests_base.TestCase):
             self.task, self.logmsg, self.errmsg, clean_up=False)
 
         self.assertFalse(self.task.driver.deploy.clean_up.called)
-        self.assertEqual([mock.call()] * 2, self.node.save.call_args_list)
+        self.node.save.assert_called_once_with()
         self.assertEqual(self.errmsg, self.node.last_error)
         self.assertEqual({}, self.node.deploy_step)
         self.assertNotIn('deploy_step_index', self.node.driver_internal_info)
         self.task.process_event.assert_called_once_with('fail')
 
+    def test_deploying_error_handler_invalid_state(self):
+        self.task.process_event.side_effect = exception.InvalidState('boom')
+
+        self.assertRaises(exception.InvalidState,
+                          conductor_utils.deploying_error_handler,
+                          self.task, self.logmsg, self.errmsg)
+
+        self.assertEqual([mock.call()] * 2, self.node.save.call_args_list)
+        self.assertEqual(self.errmsg, self.node.last_error)
+        self.assertEqual({}, self.node.deploy_step)
+        self.task.process_event.assert_called_once_with('fail')
+
     def test_deploying_error_handler_not_deploy(self):
         # Not in a deploy state
         self.node.provision_state = states.AVAILABLE
@@ -959,7 +1139,7 @@ class DeployingErrorHandlerTestCase(tests_base.TestCase):
         conductor_utils.deploying_error_handler(
             self.task, self.logmsg, self.errmsg, clean_up=False)
 
-        self.assertEqual([mock.call()] * 2, self.node.save.call_args_list)
+        self.node.save.assert_called_once_with()
         self.assertEqual(self.errmsg, self.node.last_error)
         self.assertIsNone(self.node.deploy_step)
         self.assertIn('deploy_step_index', self.node.driver_internal_info)
@@ -1362,6 +1542,41 @@ class NodeDeployStepsTestCase(db_base.DbTestCase):
                                    task, user_steps)
             mock_steps.assert_called_once_with(task, enabled=False, sort=False)
 
+    @mock.patch.object(conductor_utils, '_validate_user_step',
+                       autospec=True)
+    @mock.patch.object(conductor_utils, '_get_deployment_steps', autospec=True)
+    def test__validate_user_deploy_steps_duplicates_validated_once(
+            self, mock_steps, mock_validate):
+        mock_steps.return_value = [self.power_one, self.deploy_core]
+        mock_validate.return_value = []
+        user_steps = [{'step': 'power_one', 'interface': 'power',
+                       'priority': 200},
+                      {'step': 'power_one', 'interface': 'power',
+                       'priority': 100, 'args': {'arg1': 'val1'}}]
+
+        with task_manager.acquire(self.context, self.node.uuid) as task:
+            self.assertRaisesRegex(exception.InvalidParameterValue,
+                                   "duplicate deploy steps for "
+                                   "power.power_one",
+                                   conductor_utils._validate_user_deploy_steps,
+                                   task, user_steps)
+            mock_validate.assert_called_once_with(
+                task, user_steps[0], self.power_one, 'deploy')
+
+    def test__validate_deploy_steps_unique(self):
+        user_steps = [{'step': 'power_one', 'interface': 'power',
+                       'priority': 200},
+                      {'step': 'deploy_start', 'interface': 'deploy',
+                       'priority': 50},
+                      {'step': 'power_one', 'interface': 'power',
+                       'priority': 100},
+                      {'step': 'power_one', 'interface': 'power',
+                       'priority': 0}]
+
+        errors = conductor_utils._validate_deploy_steps_unique(user_steps)
+        self.assertEqual(1, len(errors))
+        self.assertIn('duplicate deploy steps for power.power_one', errors[0])
+
 
 class NodeCleaningStepsTestCase(db_base.DbTestCase):
     def setUp(self):
@@ -1658,7 +1873,11 @@ class ErrorHandlersTestCase(tests_base.TestCase):
             'clean_step_index': 0}
         msg = 'error bar'
         conductor_utils.cleaning_error_handler(self.task, msg)
-        self.node.save.assert_called_once_with()
+        if prov_state == states.CLEANFAIL:
+            self.node.save.assert_called_once_with()
+        else:
+            # The node is saved when processing the event
+            self.assertFalse(self.node.save.called)
         self.assertEqual({}, self.node.clean_step)
         self.assertNotIn('clean_step_index', self.node.driver_internal_info)
         self.assertEqual(msg, self.node.last_error)
@@ -1853,10 +2072,12 @@ class ErrorHandlersTestCase(tests_base.TestCase):
                                                set_fail_state=set_state)
         node_power_mock.assert_called_once_with(mock.ANY, states.POWER_OFF)
         self.task.driver.rescue.clean_up.assert_called_once_with(self.task)
-        self.node.save.assert_called_once_with()
         if set_state:
+            # The node is saved when processing the event
+            self.assertFalse(self.node.save.called)
             self.assertTrue(self.task.process_event.called)
         else:
+            self.node.save.assert_called_once_with()
             self.assertFalse(self.task.process_event.called)
 
     def test_rescuing_error_handler(self):
@@ -1882,7 +2103,8 @@ class ErrorHandlersTestCase(tests_base.TestCase):
                                          '%(error)s',
                                          {'node': self.node.uuid,
                                           'error': expected_exc})
-        self.node.save.assert_called_once_with()
+        self.assertFalse(self.node.save.called)
+        self.task.process_event.assert_called_once_with('fail')
 
     @mock.patch.object(conductor_utils.LOG, 'exception')
     @mock.patch.object(conductor_utils, 'node_power_action')
@@ -1900,7 +2122,8 @@ class ErrorHandlersTestCase(tests_base.TestCase):
                                          '%(node)s, an exception was '
                                          'encountered while aborting.',
                                          {'node': self.node.uuid})
-        self.node.save.assert_called_once_with()
+        self.assertFalse(self.node.save.called)
+        self.task.process_event.assert_called_once_with('fail')
 
     @mock.patch.object(conductor_utils.LOG, 'error')
     @mock.patch.object(conductor_utils, 'node_power_action')
@@ -2454,6 +2677,14 @@ class ValidateInstanceInfoTraitsTestCase(tests_base.TestCase):
                                conductor_utils.validate_instance_info_traits,
                                self.node)
 
+    def test_validate_instance_info_traits_missing_repeated(self):
+        self.node.instance_info['traits'] = ['trait4', 'trait1', 'trait3',
+                                             'trait4']
+        self.assertRaisesRegex(exception.InvalidParameterValue,
+                               'is missing traits trait4, trait3$',
+                               conductor_utils.validate_instance_info_traits,
+                               self.node)
+
 
 @mock.patch.object(conductor_utils, '_get_steps_from_deployment_templates',
                    autospec=True)
@@ -1339,9 +1339,13 @@ class IPMIToolPrivateMethodTestCase(Base):
 
         mock_exec.side_effect = side_effect
 
-        expected = [mock.call(self.info, "power on"),
-                    mock.call(self.info, "power status", kill_on_timeout=True),
-                    mock.call(self.info, "power status", kill_on_timeout=True)]
+        # The power state is checked right away, then with intervals of
+        # 0.05, 0.075, ... seconds until the timeout of 2 seconds is reached.
+        # The number of checks only depends on the backoff jitter, which
+        # setUp() pins with _mock_system_random_distribution().
+        expected = ([mock.call(self.info, "power on")]
+                    + [mock.call(self.info, "power status",
+                                 kill_on_timeout=True)] * 8)
 
         with task_manager.acquire(self.context, self.node.uuid) as task:
             self.assertRaises(exception.PowerStateFailure,
@@ -1380,9 +1384,9 @@ class IPMIToolPrivateMethodTestCase(Base):
 
         mock_exec.side_effect = side_effect
 
-        expected = [mock.call(self.info, "power soft"),
-                    mock.call(self.info, "power status", kill_on_timeout=True),
-                    mock.call(self.info, "power status", kill_on_timeout=True)]
+        expected = ([mock.call(self.info, "power soft")]
+                    + [mock.call(self.info, "power status",
+                                 kill_on_timeout=True)] * 8)
 
         with task_manager.acquire(self.context, self.node.uuid) as task:
             self.assertRaises(exception.PowerStateFailure,